@@ -3,13 +3,57 @@ from oslo_concurrency import processutils
 from oslo_utils import units
 from ironic_python_agent.extensions import base
 from ironic_python_agent.utils import execute
+import atexit
+from concurrent import futures
+import functools
 import hashlib
 from werkzeug.exceptions import BadRequest
 import json
 import os
+import queue
+import shlex
+import shutil
+import subprocess
+import threading
 import time
+try:
+    import orjson
+except ImportError:
+    orjson = None
 LOG = log.getLogger(__name__)
 
+_MD5 = hashlib.md5
+
+DEVICES_FILE = 'devices.json'
+# Append-only journal of device changes made since the last snapshot.
+DEVICES_LOG = 'devices.log'
+# Seconds the writer thread waits to coalesce device changes before it
+# writes them to disk.
+PERSIST_DELAY = 0.25
+# Queued to the writer thread to make it exit.
+_STOP_WRITER = object()
+# Compact the journal once it holds this many records per live device.
+LOG_COMPACT_RATIO = 4
+# Seconds to wait for a deleted block device to release its iSCSI bdev, and
+# the bounds of the exponential backoff used while polling for it.
+DETACH_TIMEOUT = 10
+DETACH_POLL_MIN = 0.05
+DETACH_POLL_MAX = 1.0
+# RPC scripts kept running in server mode, and the line ending each reply.
+RPC_SCRIPTS = ('nbl_rpc.py', 'nbl_stor_rpc.py')
+RPC_STATUS_PREFIX = '**STATUS='
+# Seconds to wait for a reply before the RPC server is killed.
+RPC_TIMEOUT = 60
+# Constant parts of the RPC command lines.
+_ISCSI_CREATE_CMD = ('nbl_stor_rpc.py', 'bdev_iscsi_create', '-b')
+_ISCSI_DELETE_CMD = ('nbl_stor_rpc.py', 'bdev_iscsi_delete')
+_BDEV_GET_CMD = ('nbl_stor_rpc.py', 'bdev_get_bdevs', '-b')
+_BLK_CREATE_CMD = ('nbl_rpc.py', 'emulator_virtio_blk_device_create', '--name')
+_BLK_CREATE_OPTS = ('--cpumask', '0x2', '--num_queues', '1')
+_BLK_DELETE_CMD = ('nbl_rpc.py', 'emulator_virtio_blk_device_delete', '--name')
+# Shared reply for check_heartbeat, which is called on every tick.
+_HEARTBEAT_OK = {'result': 'Cloud disk heartbeat successfully.'}
+
 
 class RpcCommandError(Exception):  
     """Custom exception for RPC command errors."""
@@ -21,57 +65,338 @@ class RpcCommandError(Exception):
         base_msg = super(RpcCommandError, self).__str__() 
         return f"{base_msg}. Cmd Result: {self.cmd_result}"
 
+class RpcWorkerError(Exception):
+    """The RPC server process is unusable."""
+
+class RpcReplyError(Exception):
+    """The RPC server failed after a command was sent to it."""
+
+def _dump_names(names):
+    """Serialize an iterable of device names to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(names, default=list)
+    # Join the encoded names straight from the iterable, without copying
+    # it to a list first.
+    return ('[%s]' % ', '.join(map(json.dumps, names))).encode()
+
+def _load_names(data):
+    """Deserialize device names from JSON bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Tags are cached per (ip, iqn), so each pair is hashed only once. The
+# pairs come from callers, so the caches are bounded.
+@functools.lru_cache(maxsize=4096)
+def _name_tag(ip, iqn):
+    """Return the short hash tag device names for ip and iqn end with."""
+    return hashlib.blake2b(f"{ip}_{iqn}".encode(), digest_size=4).hexdigest()
+
+@functools.lru_cache(maxsize=4096)
+def _legacy_name_tag(ip, iqn):
+    """Return the MD5 based tag used by devices created before blake2b."""
+    # The first 4 bytes give the same 8 hex characters as slicing the full
+    # hexdigest, without building the 32 character string.
+    return _MD5(f"{ip}_{iqn}".encode()).digest()[:4].hex()
+
 class DeviceManager:
     """Manage device names."""
+    _instance = None
+    _instance_lock = threading.Lock()
+
     def __init__(self):
         self._created_devices = set()
+        # (prefix, ip, iqn) -> device name for existing devices, and the
+        # reverse mapping. Filled as devices are added or looked up, since
+        # names can always be derived again from the key.
+        self._by_key = {}
+        self._by_name = {}
+        self._dirty = False
+        # Guards the device set, its indexes and the pending changes.
+        self._lock = threading.RLock()
+        # Serializes the disk writes, so that compaction never interleaves
+        # with appends. Taken before _lock, never while holding it.
+        self._io_lock = threading.Lock()
+        # Journal records not written to devices.log yet.
+        self._pending = []
+        # Set when an append failed and may have left a partial record, so
+        # the next flush replaces the journal with a snapshot.
+        self._snapshot_due = False
+        self._log_ops = 0
         self.load_devices() 
+        self._log = self._open_log()
+        self._queue = queue.Queue()
+        self._writer = self._start_writer()
+        atexit.register(self.close)
+
+    @classmethod
+    def instance(cls):
+        """Return the process-wide DeviceManager, creating it on first use.
+
+        Sharing one manager avoids reloading the devices from disk for each
+        extension instance and keeps a single writer on the journal.
+        """
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
     
-    def persist_devices(self):
+    def persist_devices(self, names=None):
+        """Write a full snapshot of the device names.
+
+        :param names: the device names to write, defaults to a copy of the
+            current ones.
+        :returns: True if the snapshot was written, False otherwise.
+        """
+        if names is None:
+            with self._lock:
+                names = tuple(self._created_devices)
+        tmp_file = DEVICES_FILE + '.tmp'
         try:
-            with open('devices.json', 'w') as f:
-                json.dump(list(self._created_devices), f)
+            # Serialize up front so the snapshot goes out in one write()
+            # instead of one per element.
+            data = _dump_names(names)
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            # The data can be rebuilt from the SmartNIC, so skip fsync and
+            # rely on the atomic rename to never leave a torn file behind.
+            os.replace(tmp_file, DEVICES_FILE)
+            return True
         except IOError as e:
             LOG.error(f"IOError occurred while persisting devices: {e}")
         except Exception as e:
             LOG.error(f"Unexpected error occurred while persisting devices: {e}")
-                
+        return False
+
+    def _open_log(self):
+        """Open the device journal for appending."""
+        try:
+            return open(DEVICES_LOG, 'ab')
+        except IOError as e:
+            LOG.error(f"Cannot open {DEVICES_LOG}, falling back to full "
+                      f"snapshots: {e}")
+            return None
+
+    def _remove_log(self):
+        """Remove a journal superseded by the snapshot.
+
+        Without a writable journal every change goes to the snapshot, and a
+        devices.log left from before would be replayed over it on restart.
+        """
+        try:
+            os.remove(DEVICES_LOG)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            LOG.error(f"Cannot remove stale {DEVICES_LOG}: {e}")
+
+    def compact(self, names, log_ops):
+        """Replace the journal with a snapshot of the given names.
+
+        :param names: the device names, including every journaled change.
+        :param log_ops: the number of journal records the names cover.
+        :returns: True if the journal was compacted, False otherwise.
+        """
+        if not self.persist_devices(names):
+            return False
+        try:
+            self._log.truncate(0)
+        except IOError as e:
+            LOG.error(f"IOError occurred while truncating {DEVICES_LOG}: {e}")
+            return False
+        with self._lock:
+            self._log_ops -= log_ops
+            self._snapshot_due = False
+        return True
+
+    def flush(self):
+        """Write pending device changes to disk, if any.
+
+        Only taking the pending changes happens under the device lock, the
+        disk writes do not block threads adding or removing devices.
+        """
+        with self._io_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                records, self._pending = self._pending, []
+                log_ops = self._log_ops
+                names = None
+                if self._log is None or self._snapshot_due or log_ops > (
+                        LOG_COMPACT_RATIO
+                        * max(len(self._created_devices), 1)):
+                    names = tuple(self._created_devices)
+            if self._log is None:
+                if self.persist_devices(names):
+                    self._remove_log()
+                return
+            # A snapshot taken with the records covers them, so they only
+            # need appending if it could not replace the journal.
+            if names is not None and self.compact(names, log_ops):
+                return
+            try:
+                self._log.write(b''.join(records))
+                self._log.flush()
+            except IOError as e:
+                LOG.error(f"IOError occurred while writing {DEVICES_LOG}: {e}")
+                # Keep the records for the next flush rather than lose them.
+                with self._lock:
+                    self._pending[:0] = records
+                    self._dirty = True
+                    self._snapshot_due = True
+
+    def _schedule_flush(self, record=None):
+        """Journal a change and hand the disk write to the writer thread."""
+        with self._lock:
+            if record is not None and self._log is not None:
+                self._pending.append(record)
+                self._log_ops += 1
+            self._dirty = True
+        self._queue.put_nowait(None)
+
+    def _start_writer(self):
+        """Start the thread writing device changes to disk."""
+        writer = threading.Thread(target=self._write_loop,
+                                  name='cloud-disk-device-writer',
+                                  daemon=True)
+        writer.start()
+        return writer
+
+    def _write_loop(self):
+        """Write queued device changes to disk in the background."""
+        stop = False
+        while not stop:
+            if self._queue.get() is _STOP_WRITER:
+                return
+            # Let the rest of a connect or disconnect catch up, then fold
+            # everything queued meanwhile into a single write.
+            time.sleep(PERSIST_DELAY)
+            try:
+                while True:
+                    if self._queue.get_nowait() is _STOP_WRITER:
+                        stop = True
+            except queue.Empty:
+                pass
+            try:
+                self.flush()
+            except Exception as e:
+                LOG.error(f"Unexpected error occurred while writing devices: {e}")
+
+    def close(self):
+        """Stop the writer thread, write pending changes and close the log."""
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return
+        self._queue.put_nowait(_STOP_WRITER)
+        writer.join()
+        self.flush()
+        if self._log is not None:
+            self._log.close()
+
     def load_devices(self):
         try:
-            if os.path.exists('devices.json'):
-                with open('devices.json', 'r') as f:
-                    devices = json.load(f)
+            if os.path.exists(DEVICES_FILE):
+                with open(DEVICES_FILE, 'rb') as f:
+                    devices = _load_names(f.read())
                     self._created_devices = set(devices)
             else:
-                print("No existing devices.json file found. Starting with an empty set.")
+                LOG.debug("No existing devices.json file found. Starting with an empty set.")
         except json.JSONDecodeError:
             LOG.warning("Error reading devices.json. Starting with an empty set.")
         except Exception as e:
             LOG.warning(f"An unexpected error occurred: {e}. Starting with an empty set.")                
+        self._replay_log()
+
+    def _replay_log(self):
+        """Apply the journaled device changes on top of the snapshot."""
+        if not os.path.exists(DEVICES_LOG):
+            return
+        try:
+            # Offset just past the last complete record.
+            end = 0
+            with open(DEVICES_LOG, 'rb') as f:
+                for record in f:
+                    # A record torn by a crash has no newline, drop it.
+                    if not record.endswith(b'\n'):
+                        break
+                    device_name = record[1:-1].decode()
+                    if record.startswith(b'+'):
+                        self._created_devices.add(device_name)
+                    elif record.startswith(b'-'):
+                        self._created_devices.discard(device_name)
+                    self._log_ops += 1
+                    end += len(record)
+                torn = f.tell() > end
+            if torn:
+                # Cut the torn record off, or the next append would be
+                # glued onto it and lost on the following replay.
+                LOG.warning(f"Dropping torn record at the end of "
+                            f"{DEVICES_LOG}.")
+                os.truncate(DEVICES_LOG, end)
+        except Exception as e:
+            LOG.warning(f"Error replaying {DEVICES_LOG}: {e}. "
+                        f"Recent device changes may be missing.")
 
     def _find_unique_name(self, prefix, ip, iqn):
-        """Find unique device name using ip and iqn."""
-        unique_hash = hashlib.md5(f"{ip}_{iqn}".encode()).hexdigest()[:8]
-        unique_name = f"{prefix}{unique_hash}"
+        """Find unique device name using ip and iqn.
+
+        Devices persisted by older agents were named with an MD5 tag, so
+        fall back to that name when only it is known.
+        """
+        unique_name = prefix + _name_tag(ip, iqn)
+        if unique_name not in self._created_devices:
+            legacy_name = prefix + _legacy_name_tag(ip, iqn)
+            if legacy_name in self._created_devices:
+                return legacy_name
         return unique_name
 
+    def _index(self, key, device_name):
+        """Record the key of an existing device name."""
+        self._by_key[key] = device_name
+        self._by_name[device_name] = key
+
+    def _find_device_name(self, prefix, ip, iqn):
+        """Return the existing device name for ip and iqn, or None."""
+        key = (prefix, ip, iqn)
+        with self._lock:
+            device_name = self._by_key.get(key)
+            if device_name is None:
+                device_name = self._find_unique_name(prefix, ip, iqn)
+                if device_name not in self._created_devices:
+                    return None
+                self._index(key, device_name)
+            return device_name
+
     def _generate_unique_name(self, prefix, ip, iqn):
         """Generate unique device name using ip and iqn."""
-        unique_hash = hashlib.md5(f"{ip}_{iqn}".encode()).hexdigest()[:8]
-        unique_name = f"{prefix}{unique_hash}"
-        if unique_name in self._created_devices:
-            raise ValueError(f"Device name '{unique_name}' already exists.")
-        return unique_name
+        with self._lock:
+            existing_name = self._find_device_name(prefix, ip, iqn)
+            if existing_name is not None:
+                raise ValueError(f"Device name '{existing_name}' already exists.")
+            return prefix + _name_tag(ip, iqn)
+
+    def add_device_name(self, device_name, key=None):
+        """Add the device name to the set.
 
-    def add_device_name(self, device_name):
-        """Add the device name to the set."""
-        self._created_devices.add(device_name)
-        self.persist_devices()
+        :param key: optional (prefix, ip, iqn) tuple the name was generated
+            from, so that later lookups need not derive it again.
+        """
+        with self._lock:
+            self._created_devices.add(device_name)
+            if key is not None:
+                self._index(key, device_name)
+            self._schedule_flush(b'+' + device_name.encode() + b'\n')
 
     def remove_device_name(self, device_name):
         """Remove the device name from the set."""
-        self._created_devices.discard(device_name)
-        self.persist_devices()
+        with self._lock:
+            self._created_devices.discard(device_name)
+            key = self._by_name.pop(device_name, None)
+            if key is not None and self._by_key.get(key) == device_name:
+                del self._by_key[key]
+            self._schedule_flush(b'-' + device_name.encode() + b'\n')
 
     def get_iscsi_name(self, ip, iqn):
         """Generate iSCSI device name."""
@@ -83,44 +408,185 @@ class DeviceManager:
 
     def check_iscsi_name(self, ip, iqn):
         """Check if the iSCSI name exists."""
-        iscsi_name = self._find_unique_name("iscsi", ip, iqn)
-        if iscsi_name not in self._created_devices:
+        iscsi_name = self._find_device_name("iscsi", ip, iqn)
+        if iscsi_name is None:
+            iscsi_name = self._find_unique_name("iscsi", ip, iqn)
             raise ValueError(f"iSCSI name '{iscsi_name}' does not exist.")
         return iscsi_name
 
     def check_blk_name(self, ip, iqn):
         """Check if the block device name exists."""
-        blk_name = self._find_unique_name("blk", ip, iqn)
-        if blk_name not in self._created_devices:
+        blk_name = self._find_device_name("blk", ip, iqn)
+        if blk_name is None:
+            blk_name = self._find_unique_name("blk", ip, iqn)
             raise ValueError(f"Block device name '{blk_name}' does not exist.")
         return blk_name
 
     def print_all_device_names(self):
       """Print all device names."""
-      if self._created_devices:
-          LOG.warning("Device Names:")
-          for device_name in self._created_devices:
-              print(device_name)
+      with self._lock:
+          names = sorted(self._created_devices)
+      if names:
+          LOG.info("Device Names:\n%s", "\n".join(names))
       else:
           LOG.warning("No devices found.")
             
+@functools.lru_cache(maxsize=4096)
+def _iscsi_create_argv(iscsi_value, ip, iqn):
+    """Return the bdev_iscsi_create command line, cached for retries."""
+    return (*_ISCSI_CREATE_CMD, iscsi_value, '-i', iqn + '/0',
+            '--url', f'iscsi://{ip}/{iqn}/0')
+
+@functools.lru_cache(maxsize=4096)
+def _blk_create_argv(blk_value, iscsi_value):
+    """Return the emulator_virtio_blk_device_create command line."""
+    return (*_BLK_CREATE_CMD, blk_value, *_BLK_CREATE_OPTS,
+            '--bdev_name', iscsi_value, '--rom_idx', '0')
+
+def _join_args(args):
+    """Quote and join command arguments into one shell-style line."""
+    return ' '.join(shlex.quote(arg) for arg in args)
+
+class RpcWorker:
+    """Long-lived RPC script running in server mode.
+
+    Commands are written to the script's stdin one per line and every reply
+    ends with a '**STATUS=<rc>' line, which saves starting a new Python
+    interpreter for each RPC.
+    """
+    def __init__(self, script):
+        self.script = script
+        self.available = True
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # File descriptors are not inheritable by default (PEP 446), so
+        # skip the close_fds loop. Together with an absolute executable
+        # path this lets CPython use posix_spawn instead of fork+exec.
+        executable = shutil.which(self.script)
+        if executable is None:
+            raise OSError(f"{self.script} not found")
+        self._proc = subprocess.Popen([executable, '--server'],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      universal_newlines=True, bufsize=1,
+                                      close_fds=False)
+
+    def stop(self):
+        """Stop the server process, if running."""
+        if self._proc is not None:
+            try:
+                self._proc.stdin.close()
+                self._proc.wait(timeout=1)
+            except Exception:
+                self._proc.kill()
+            self._proc = None
+
+    def _expire(self, proc):
+        """Kill a server that did not reply in time."""
+        LOG.error(f"{self.script} server gave no reply within {RPC_TIMEOUT} "
+                  f"seconds, killing it.")
+        proc.kill()
+
+    def execute(self, *args):
+        """Run one command, returning its output.
+
+        Stderr is merged into the output.
+
+        :raises: ProcessExecutionError if the command failed.
+        :raises: RpcWorkerError if the command could not be sent to the
+            server, which is then marked unavailable.
+        :raises: RpcReplyError if the server failed or gave no reply within
+            RPC_TIMEOUT seconds after the command was sent. It is restarted
+            for the next command.
+        """
+        with self._lock:
+            try:
+                if self._proc is None or self._proc.poll() is not None:
+                    self._start()
+                self._proc.stdin.write(_join_args(args) + '\n')
+                self._proc.stdin.flush()
+            except Exception as e:
+                # The command never reached the server, so it is safe to
+                # run it again without the server.
+                self.available = False
+                self.stop()
+                raise RpcWorkerError(f"{self.script} server failed: {e}")
+            proc = self._proc
+            # Kill a hung server, so that one stuck command does not block
+            # every other command for this script behind the lock.
+            timer = threading.Timer(RPC_TIMEOUT, self._expire, (proc,))
+            timer.start()
+            try:
+                output = []
+                while True:
+                    line = proc.stdout.readline()
+                    if not line:
+                        raise EOFError(f"{self.script} exited")
+                    if line.startswith(RPC_STATUS_PREFIX):
+                        break
+                    output.append(line)
+                exit_code = int(line[len(RPC_STATUS_PREFIX):])
+            except Exception as e:
+                # The server may have run the command already, so it must
+                # not run again. The rest of the reply may still be in the
+                # pipe, so restart the server for the next command.
+                self.stop()
+                raise RpcReplyError(f"{self.script} server failed after "
+                                    f"the command was sent: {e}")
+            finally:
+                timer.cancel()
+        stdout = ''.join(output)
+        if exit_code:
+            raise processutils.ProcessExecutionError(
+                stdout=stdout, exit_code=exit_code,
+                cmd=_join_args((self.script,) + args))
+        return stdout
+
 class RpcManager:
     """Manage RPC commands."""
     def __init__(self):
-        self.device_manager = DeviceManager()
+        self.device_manager = DeviceManager.instance()
+        self._workers = {script: RpcWorker(script) for script in RPC_SCRIPTS}
+
+    def _execute(self, *cmd):
+        """Run an RPC command, preferring the script's server process.
+
+        The exit status alone tells whether the command failed, as the
+        server merges stderr into the reply. Stderr of a successful command
+        is only logged.
+
+        Only a command that never reached the server is run again without
+        it, since the RPCs are not idempotent.
+
+        :returns: the command's stdout.
+        :raises: ProcessExecutionError if the command failed.
+        :raises: RpcReplyError if the server failed after the command was
+            sent to it.
+        """
+        worker = self._workers.get(cmd[0])
+        if worker is not None and worker.available:
+            try:
+                return worker.execute(*cmd[1:])
+            except RpcWorkerError as e:
+                LOG.warning(f"{e}. Falling back to one process per command.")
+        stdout, stderr = execute(*cmd)
+        if stderr:
+            LOG.warning(f"{cmd[0]} {cmd[1]} wrote to stderr: {stderr}")
+        return stdout
 
     # instance: nbl_stor_rpc.py bdev_iscsi_create -b <iscsi00> -i <iqn.2016-06.io.spdk:disk1/0> --url <iscsi://T_ip/iqn.2016-06.io.spdk:disk1/0>
     def execute_rpc_create_iscsi_bdev(self, iqn, ip):
         """Execute the RPC command to create iSCSI bdev."""
         iscsi_value = self.device_manager.get_iscsi_name(ip, iqn)
-        cmd = ['nbl_stor_rpc.py', 'bdev_iscsi_create', '-b', iscsi_value, '-i', iqn + '/0', '--url', f'iscsi://{ip}/{iqn}/0']
+        cmd = _iscsi_create_argv(iscsi_value, ip, iqn)
         try:
-            stdout, stderr = execute(*cmd)
+            stdout = self._execute(*cmd)
             LOG.info(stdout)
-            if stderr:
-                raise RpcCommandError(f"Error executing bdev_iscsi_create command. Error: {stderr}", {'stdout': stdout, 'stderr': stderr})
             
-            self.device_manager.add_device_name(iscsi_value)
+            self.device_manager.add_device_name(iscsi_value, ('iscsi', ip, iqn))
             return iscsi_value
         except Exception as e:  
             msg = f"Failed to execute bdev_iscsi_create command for IQN {iqn} and IP {ip}: {e}"
@@ -131,27 +597,12 @@ class RpcManager:
     def execute_rpc_emulator_virtio_blk_device_create(self, iscsi_value, ip, iqn):
         """Execute the RPC command to create emulator virtio block device."""
         blk_value = self.device_manager.get_blk_name(ip, iqn)
-        cmd = [
-            'nbl_rpc.py',
-            'emulator_virtio_blk_device_create',
-            '--name',
-            blk_value,
-            '--cpumask',
-            '0x2',
-            '--num_queues',
-            '1',
-            '--bdev_name',
-            iscsi_value,
-            '--rom_idx',
-            '0'
-        ]
+        cmd = _blk_create_argv(blk_value, iscsi_value)
         try:
-            stdout, stderr = execute(*cmd)
+            stdout = self._execute(*cmd)
             LOG.info(stdout)
-            if stderr:
-                raise RpcCommandError(f"Error executing emulator_virtio_blk_device_create command. Error: {stderr}", {'stdout': stdout, 'stderr': stderr})
             
-            self.device_manager.add_device_name(blk_value)
+            self.device_manager.add_device_name(blk_value, ('blk', ip, iqn))
             return blk_value
         except Exception as e: 
             msg = f"Failed to execute emulator_virtio_blk_device_create command for iscsi_value {iscsi_value}: {e}"
@@ -160,12 +611,10 @@ class RpcManager:
 
     def execute_rpc_emulator_virtio_blk_device_delete(self, blk_name):
         """Execute the RPC command to delete emulator virtio block device."""
-        cmd = ['nbl_rpc.py', 'emulator_virtio_blk_device_delete', '--name', blk_name]
+        cmd = (*_BLK_DELETE_CMD, blk_name)
         try:
-            stdout, stderr = execute(*cmd)
+            stdout = self._execute(*cmd)
             LOG.info(stdout)
-            if stderr:
-                raise RpcCommandError(f"Error executing emulator_virtio_blk_device_delete command. Error: {stderr}", {'stdout': stdout, 'stderr': stderr})
             self.device_manager.remove_device_name(blk_name)  
         except Exception as e:
             msg = f"Failed to execute emulator_virtio_blk_device_delete command for block device name {blk_name}: {e}"
@@ -174,23 +623,62 @@ class RpcManager:
 
     def execute_rpc_bdev_iscsi_delete(self, iscsi_name):
         """Execute the RPC command to delete iSCSI bdev."""
-        cmd = ['nbl_stor_rpc.py', 'bdev_iscsi_delete', iscsi_name]
+        cmd = (*_ISCSI_DELETE_CMD, iscsi_name)
         try:
-            stdout, stderr = execute(*cmd)
+            stdout = self._execute(*cmd)
             LOG.info(stdout)
-            if stderr:
-                raise RpcCommandError(f"Error executing bdev_iscsi_delete command. Error: {stderr}", {'stdout': stdout, 'stderr': stderr})
             self.device_manager.remove_device_name(iscsi_name)
         except Exception as e:
             msg = f"Failed to execute bdev_iscsi_delete command for iSCSI name {iscsi_name}: {e}"
             LOG.error(msg)
             raise RpcCommandError(msg, {'stdout': '', 'stderr': str(e)})
 
+    # instance: nbl_stor_rpc.py bdev_get_bdevs -b <iscsixx>
+    def wait_iscsi_bdev_released(self, iscsi_name, timeout=DETACH_TIMEOUT):
+        """Wait until the iSCSI bdev is no longer claimed by a block device.
+
+        Polls with exponential backoff, since the block device is usually
+        gone well before the timeout.
+
+        :returns: True if the bdev was released, False on timeout.
+        """
+        cmd = (*_BDEV_GET_CMD, iscsi_name)
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            try:
+                stdout = self._execute(*cmd)
+                if not any(bdev.get('claimed')
+                           for bdev in json.loads(stdout)):
+                    return True
+            except Exception as e:
+                LOG.debug(f"bdev_get_bdevs failed for {iscsi_name}: {e}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                LOG.warning(f"iSCSI bdev {iscsi_name} still claimed after {timeout} seconds.")
+                return False
+            time.sleep(min(DETACH_POLL_MAX, DETACH_POLL_MIN * 2 ** attempt,
+                           remaining))
+            attempt += 1
+
 class CloudDiskExtension(base.BaseAgentExtension):
     """Cloud disk extension for handling cloud disk related commands."""
+    # Rollbacks run in the background so a failed connect returns at once.
+    _rollback_pool = futures.ThreadPoolExecutor(max_workers=2)
+
     def __init__(self, agent=None):
         super(CloudDiskExtension, self).__init__(agent=agent)
         self.rpc_manager = RpcManager()
+        # atexit runs hooks in reverse order, so registering here, after
+        # RpcManager() set up the DeviceManager, lets pending rollbacks
+        # finish before its close() stops journaling. Before Python 3.9,
+        # concurrent.futures only drains pools from an atexit hook of its
+        # own, registered at import and so run after close().
+        atexit.register(self._rollback_pool.shutdown)
+        # (ip, iqn) -> future of a rollback still deleting the iSCSI bdev
+        # of a failed connect.
+        self._rollbacks = {}
+        self._rollbacks_lock = threading.Lock()
 
     @base.sync_command('connect_cloud_disk')
     def connect_cloud_disk(self, iqn, ip):
@@ -200,6 +688,10 @@ class CloudDiskExtension(base.BaseAgentExtension):
         try:
             LOG.info("Received IP: %s", ip)
             LOG.info("Received IQN: %s", iqn)
+
+            # Step 0: Wait for the rollback of a failed attempt, which
+            # would otherwise race this one over the same iSCSI name
+            self._wait_for_rollback(ip, iqn)
           
             # Step 1: Create iSCSI bdev
             iscsi_value = self.rpc_manager.execute_rpc_create_iscsi_bdev(iqn, ip)
@@ -221,10 +713,37 @@ class CloudDiskExtension(base.BaseAgentExtension):
         finally:      
             if iscsi_value and not blk_value:
                LOG.warning(f"Rolling back due to error. Deleting iSCSI bdev: {iscsi_value}")
-               try:
-                    self.rpc_manager.execute_rpc_bdev_iscsi_delete(iscsi_value)
-               except Exception as rollback_err:
-                    LOG.error(f"Error during rollback operation: {rollback_err}")
+               self._start_rollback(ip, iqn, iscsi_value)
+
+    def _start_rollback(self, ip, iqn, iscsi_value):
+        """Delete the iSCSI bdev of a failed connect in the background."""
+        key = (ip, iqn)
+        future = self._rollback_pool.submit(self._rollback_iscsi_bdev,
+                                            iscsi_value)
+        with self._rollbacks_lock:
+            self._rollbacks[key] = future
+        future.add_done_callback(functools.partial(self._forget_rollback, key))
+
+    def _forget_rollback(self, key, future):
+        """Drop a finished rollback, unless a newer one replaced it."""
+        with self._rollbacks_lock:
+            if self._rollbacks.get(key) is future:
+                del self._rollbacks[key]
+
+    def _wait_for_rollback(self, ip, iqn):
+        """Wait until a pending rollback for ip and iqn is done."""
+        with self._rollbacks_lock:
+            future = self._rollbacks.get((ip, iqn))
+        if future is not None:
+            LOG.info(f"Waiting for the rollback of a failed connect for IP {ip} and IQN {iqn}.")
+            future.result()
+
+    def _rollback_iscsi_bdev(self, iscsi_value):
+        """Delete an iSCSI bdev left behind by a failed connect."""
+        try:
+            self.rpc_manager.execute_rpc_bdev_iscsi_delete(iscsi_value)
+        except Exception as rollback_err:
+            LOG.error(f"Error during rollback operation: {rollback_err}")
 
     @base.sync_command('disconnect_cloud_disk')
     def disconnect_cloud_disk(self, iqn, ip):
@@ -235,15 +754,16 @@ class CloudDiskExtension(base.BaseAgentExtension):
             LOG.info("Received IP: %s", ip)
             LOG.info("Received IQN: %s", iqn)
 
-            # Step 1: Get the block device name
+            # Step 1: Get the block device and iSCSI names up front, so
+            # nothing but the detach wait sits between the two deletes
             blk_name = self.rpc_manager.device_manager.check_blk_name(ip, iqn)
+            iscsi_name = self.rpc_manager.device_manager.check_iscsi_name(ip, iqn)
             
             # Step 2: Delete emulator virtio block device
             self.rpc_manager.execute_rpc_emulator_virtio_blk_device_delete(blk_name)
             
-            # Step 3: Get the iSCSI name
-            iscsi_name = self.rpc_manager.device_manager.check_iscsi_name(ip, iqn)
-            time.sleep(10)
+            # Step 3: Wait for the block device to release the iSCSI bdev
+            self.rpc_manager.wait_iscsi_bdev_released(iscsi_name)
             # Step 4: Delete iSCSI bdev
             self.rpc_manager.execute_rpc_bdev_iscsi_delete(iscsi_name)
             
@@ -261,10 +781,10 @@ class CloudDiskExtension(base.BaseAgentExtension):
             
     @base.async_command('check_heartbeat')
     def check_heartbeat(self, ip):
-        """Disconnect cloud disk using the given iqn and ip."""
+        """Acknowledge a heartbeat from the given ip."""
   
-        LOG.info("Received heartbeat from IP: %s", ip)     
-        return {'result': 'Cloud disk heartbeat successfully.'}
+        LOG.debug("Received heartbeat from IP: %s", ip)     
+        return _HEARTBEAT_OK
         
     @base.async_command('print_all_devices')
     def print_all_devices(self):
@@ -0,0 +1,701 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from oslo_concurrency import processutils
+
+from ironic_python_agent.extensions import cloud_disk
+from ironic_python_agent.tests.unit import base
+
+IP = '192.0.2.10'
+IQN = 'iqn.2016-06.io.spdk:disk1'
+
+
+class TestDeviceManager(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDeviceManager, self).setUp()
+        self.mock_load = self._patch_object(cloud_disk.DeviceManager,
+                                            'load_devices')
+        self.mock_persist = self._patch_object(cloud_disk.DeviceManager,
+                                               'persist_devices')
+        self.mock_writer = self._patch_object(cloud_disk.DeviceManager,
+                                              '_start_writer').return_value
+        self.mock_log = self._patch_object(cloud_disk.DeviceManager,
+                                           '_open_log').return_value
+        self._patch_object(cloud_disk.atexit, 'register')
+        for tag_cache in (cloud_disk._name_tag, cloud_disk._legacy_name_tag):
+            tag_cache.cache_clear()
+            self.addCleanup(tag_cache.cache_clear)
+        self.manager = cloud_disk.DeviceManager()
+
+    def _patch_object(self, target, attribute):
+        patcher = mock.patch.object(target, attribute, autospec=True)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    @mock.patch.object(cloud_disk.DeviceManager, '_instance', None)
+    def test_instance(self):
+        self.mock_load.reset_mock()
+        manager = cloud_disk.DeviceManager.instance()
+        self.assertIsInstance(manager, cloud_disk.DeviceManager)
+        self.assertIs(manager, cloud_disk.DeviceManager.instance())
+        self.mock_load.assert_called_once_with(manager)
+
+    def test_names_share_hash(self):
+        iscsi_name = self.manager.get_iscsi_name(IP, IQN)
+        blk_name = self.manager.get_blk_name(IP, IQN)
+        self.assertTrue(iscsi_name.startswith('iscsi'))
+        self.assertTrue(blk_name.startswith('blk'))
+        self.assertEqual(iscsi_name[len('iscsi'):], blk_name[len('blk'):])
+        self.assertEqual(8, len(blk_name) - len('blk'))
+
+    @mock.patch.object(cloud_disk.hashlib, 'blake2b', autospec=True)
+    def test_hash_is_cached(self, mock_blake2b):
+        mock_blake2b.return_value.hexdigest.return_value = 'deadbeef'
+        self.manager.add_device_name('blkdeadbeef')
+        self.assertEqual('iscsideadbeef', self.manager.get_iscsi_name(IP, IQN))
+        self.assertEqual('blkdeadbeef', self.manager.check_blk_name(IP, IQN))
+        mock_blake2b.assert_called_once_with(f'{IP}_{IQN}'.encode(),
+                                             digest_size=4)
+
+    @mock.patch.object(cloud_disk, '_MD5', autospec=True)
+    def test_legacy_hash_is_cached(self, mock_md5):
+        mock_md5.return_value.digest.return_value = b'\xca\xfe\xba\xbe'
+        self.assertRaises(ValueError, self.manager.check_iscsi_name, IP, IQN)
+        self.assertRaises(ValueError, self.manager.check_blk_name, IP, IQN)
+        self.assertEqual('cafebabe', cloud_disk._legacy_name_tag(IP, IQN))
+        mock_md5.assert_called_once_with(f'{IP}_{IQN}'.encode())
+
+    def test_tag_caches_are_bounded(self):
+        for i in range(5000):
+            self.assertRaises(ValueError, self.manager.check_blk_name,
+                              f'192.0.2.{i}', IQN)
+        self.assertEqual(4096, cloud_disk._name_tag.cache_info().currsize)
+        self.assertEqual(4096,
+                         cloud_disk._legacy_name_tag.cache_info().currsize)
+
+    def test_check_uses_index(self):
+        blk_name = self.manager.get_blk_name(IP, IQN)
+        self.manager.add_device_name(blk_name, ('blk', IP, IQN))
+        with mock.patch.object(cloud_disk, '_name_tag',
+                               autospec=True) as mock_tag:
+            self.assertEqual(blk_name, self.manager.check_blk_name(IP, IQN))
+            self.assertFalse(mock_tag.called)
+
+        self.manager.remove_device_name(blk_name)
+        self.assertEqual({}, self.manager._by_key)
+        self.assertEqual({}, self.manager._by_name)
+        self.assertRaises(ValueError, self.manager.check_blk_name, IP, IQN)
+
+    def test_check_legacy_name(self):
+        legacy_name = 'blk' + cloud_disk.hashlib.md5(
+            f'{IP}_{IQN}'.encode()).hexdigest()[:8]
+        self.manager.add_device_name(legacy_name)
+        self.assertEqual(legacy_name, self.manager.check_blk_name(IP, IQN))
+        self.assertRaises(ValueError, self.manager.get_blk_name, IP, IQN)
+
+    def test_generate_existing_name(self):
+        self.manager.add_device_name(self.manager.get_blk_name(IP, IQN))
+        self.assertRaises(ValueError, self.manager.get_blk_name, IP, IQN)
+
+    def test_check_missing_name(self):
+        self.assertRaises(ValueError, self.manager.check_iscsi_name, IP, IQN)
+        self.assertRaises(ValueError, self.manager.check_blk_name, IP, IQN)
+
+    def test_add_remove_device_name(self):
+        self.manager.add_device_name('blk0')
+        self.assertIn('blk0', self.manager._created_devices)
+        self.manager.remove_device_name('blk0')
+        self.assertNotIn('blk0', self.manager._created_devices)
+        self.assertEqual(2, self.manager._queue.qsize())
+        self.assertFalse(self.mock_log.write.called)
+
+        self.manager.flush()
+        self.mock_log.write.assert_called_once_with(b'+blk0\n-blk0\n')
+        self.mock_log.flush.assert_called_once_with()
+        self.assertFalse(self.mock_persist.called)
+        self.assertEqual([], self.manager._pending)
+
+    def test_changes_during_flush_stay_pending(self):
+        def write(data):
+            self.manager.add_device_name('blk1')
+
+        self.mock_log.write.side_effect = write
+        self.manager.add_device_name('blk0')
+        self.manager.flush()
+        self.mock_log.write.assert_called_once_with(b'+blk0\n')
+        self.assertEqual([b'+blk1\n'], self.manager._pending)
+        self.assertTrue(self.manager._dirty)
+
+    @mock.patch.object(cloud_disk.time, 'sleep', autospec=True)
+    def test_write_loop_coalesces(self, mock_sleep):
+        self.manager._queue = mock.Mock(spec=queue.Queue)
+        self.manager._queue.get.side_effect = [None, None, RuntimeError]
+        self.manager._queue.get_nowait.side_effect = [None, None, queue.Empty,
+                                                      queue.Empty]
+        with mock.patch.object(self.manager, 'flush', autospec=True,
+                               side_effect=[IOError, None]) as mock_flush:
+            self.assertRaises(RuntimeError, self.manager._write_loop)
+        self.assertEqual(2, mock_flush.call_count)
+        mock_sleep.assert_called_with(cloud_disk.PERSIST_DELAY)
+
+    @mock.patch.object(cloud_disk.time, 'sleep', autospec=True)
+    def test_write_loop_stops(self, mock_sleep):
+        self.manager._queue.put_nowait(None)
+        self.manager._queue.put_nowait(cloud_disk._STOP_WRITER)
+        with mock.patch.object(self.manager, 'flush',
+                               autospec=True) as mock_flush:
+            self.manager._write_loop()
+        mock_flush.assert_called_once_with()
+
+    def test_close(self):
+        self.manager.add_device_name('blk0')
+        with mock.patch.object(self.manager, '_queue',
+                               autospec=True) as mock_queue:
+            self.manager.close()
+            self.manager.close()
+        mock_queue.put_nowait.assert_called_once_with(cloud_disk._STOP_WRITER)
+        self.mock_writer.join.assert_called_once_with()
+        self.mock_log.write.assert_called_once_with(b'+blk0\n')
+        self.mock_log.close.assert_called_once_with()
+
+    def test_flush_compacts_log(self):
+        self.mock_persist.return_value = True
+        for _ in range(3):
+            self.manager.add_device_name('blk0')
+            self.manager.remove_device_name('blk0')
+        self.manager.flush()
+        self.mock_persist.assert_called_once_with(self.manager, ())
+        self.mock_log.truncate.assert_called_once_with(0)
+        self.assertFalse(self.mock_log.write.called)
+        self.assertEqual(0, self.manager._log_ops)
+
+    def test_flush_compaction_failed(self):
+        self.mock_persist.return_value = False
+        for _ in range(3):
+            self.manager.add_device_name('blk0')
+            self.manager.remove_device_name('blk0')
+        self.manager.flush()
+        self.assertFalse(self.mock_log.truncate.called)
+        self.mock_log.write.assert_called_once_with(b'+blk0\n-blk0\n' * 3)
+        self.assertEqual(6, self.manager._log_ops)
+
+    def test_flush_append_failed(self):
+        self.mock_log.write.side_effect = IOError('No space left on device')
+        self.manager.add_device_name('blkA')
+        self.manager.flush()
+        self.assertEqual([b'+blkA\n'], self.manager._pending)
+        self.assertTrue(self.manager._dirty)
+
+        self.mock_log.write.side_effect = None
+        self.mock_persist.return_value = True
+        self.manager.add_device_name('blkB')
+        self.manager.flush()
+        self.mock_persist.assert_called_once_with(self.manager, mock.ANY)
+        self.assertEqual({'blkA', 'blkB'},
+                         set(self.mock_persist.call_args[0][1]))
+        self.mock_log.truncate.assert_called_once_with(0)
+        self.assertEqual([], self.manager._pending)
+        self.assertEqual(0, self.manager._log_ops)
+        self.assertFalse(self.manager._snapshot_due)
+
+    def test_flush_append_retried(self):
+        self.mock_log.write.side_effect = [IOError('No space left on device'),
+                                           None]
+        self.mock_persist.return_value = False
+        self.manager.add_device_name('blkA')
+        self.manager.flush()
+        self.manager.add_device_name('blkB')
+        self.manager.flush()
+        self.mock_log.write.assert_called_with(b'+blkA\n+blkB\n')
+        self.assertEqual([], self.manager._pending)
+
+    @mock.patch.object(cloud_disk.os, 'remove', autospec=True)
+    def test_flush_without_log(self, mock_remove):
+        self.manager._log = None
+        self.manager.add_device_name('blk0')
+        self.manager.flush()
+        self.mock_persist.assert_called_once_with(self.manager, ('blk0',))
+        mock_remove.assert_called_once_with(cloud_disk.DEVICES_LOG)
+        self.assertEqual([], self.manager._pending)
+
+    @mock.patch.object(cloud_disk, 'LOG', autospec=True)
+    def test_print_all_device_names(self, mock_log):
+        self.manager._created_devices = {'iscsi0', 'blk0'}
+        self.manager.print_all_device_names()
+        mock_log.info.assert_called_once_with('Device Names:\n%s',
+                                              'blk0\niscsi0')
+
+    def test_flush_not_dirty(self):
+        self.manager.flush()
+        self.assertFalse(self.mock_persist.called)
+
+
+class TestDevicePersistence(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDevicePersistence, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.devices_file = os.path.join(tmpdir, 'devices.json')
+        self.devices_log = os.path.join(tmpdir, 'devices.log')
+        patcher = mock.patch.multiple(cloud_disk,
+                                      DEVICES_FILE=self.devices_file,
+                                      DEVICES_LOG=self.devices_log)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(cloud_disk.atexit, 'register',
+                                    autospec=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _manager(self):
+        manager = cloud_disk.DeviceManager()
+        self.addCleanup(manager.close)
+        return manager
+
+    def test_load_missing_file(self):
+        manager = self._manager()
+        self.assertEqual(set(), manager._created_devices)
+
+    def test_writer_thread(self):
+        manager = cloud_disk.DeviceManager()
+        writer = manager._writer
+        self.assertEqual('cloud-disk-device-writer', writer.name)
+        self.assertTrue(writer.daemon)
+        self.assertTrue(writer.is_alive())
+        manager.add_device_name('blk0')
+        manager.close()
+        self.assertFalse(writer.is_alive())
+        self.assertEqual({'blk0'}, self._manager()._created_devices)
+
+    def test_persist_and_load(self):
+        manager = self._manager()
+        manager._created_devices = {'iscsi0', 'blk0'}
+        manager.persist_devices()
+        with open(self.devices_file) as f:
+            self.assertEqual({'iscsi0', 'blk0'}, set(json.load(f)))
+        self.assertFalse(os.path.exists(self.devices_file + '.tmp'))
+        self.assertEqual({'iscsi0', 'blk0'},
+                         self._manager()._created_devices)
+
+    @mock.patch.object(cloud_disk, 'orjson', None)
+    def test_persist_and_load_without_orjson(self):
+        self.test_persist_and_load()
+
+    def test_load_invalid_file(self):
+        with open(self.devices_file, 'w') as f:
+            f.write('[not json')
+        manager = self._manager()
+        self.assertEqual(set(), manager._created_devices)
+
+    def test_replay_log(self):
+        with open(self.devices_file, 'w') as f:
+            json.dump(['iscsi0', 'blk0'], f)
+        with open(self.devices_log, 'wb') as f:
+            f.write(b'+iscsi1\n-blk0\n+blk1\n+torn')
+        manager = self._manager()
+        self.assertEqual({'iscsi0', 'iscsi1', 'blk1'},
+                         manager._created_devices)
+        self.assertEqual(3, manager._log_ops)
+
+    def test_append_after_torn_record(self):
+        with open(self.devices_log, 'wb') as f:
+            f.write(b'+iscsiaaaa\n+torn')
+        manager = self._manager()
+        with open(self.devices_log, 'rb') as f:
+            self.assertEqual(b'+iscsiaaaa\n', f.read())
+        manager.add_device_name('iscsibbbb')
+        manager.flush()
+        self.assertEqual({'iscsiaaaa', 'iscsibbbb'},
+                         self._manager()._created_devices)
+
+    def test_snapshot_removes_stale_log(self):
+        with open(self.devices_log, 'wb') as f:
+            f.write(b'+blk0\n')
+        with mock.patch.object(cloud_disk.DeviceManager, '_open_log',
+                               autospec=True, return_value=None):
+            manager = self._manager()
+        self.assertEqual({'blk0'}, manager._created_devices)
+        manager.remove_device_name('blk0')
+        manager.flush()
+        self.assertFalse(os.path.exists(self.devices_log))
+        self.assertEqual(set(), self._manager()._created_devices)
+
+    def test_log_survives_restart(self):
+        manager = self._manager()
+        manager.add_device_name('blk0')
+        manager.add_device_name('blk1')
+        manager.remove_device_name('blk0')
+        manager.flush()
+        self.assertEqual({'blk1'},
+                         self._manager()._created_devices)
+
+
+@mock.patch.object(cloud_disk.time, 'sleep', autospec=True)
+@mock.patch.object(cloud_disk, 'execute', autospec=True)
+class TestRpcManager(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestRpcManager, self).setUp()
+        patcher = mock.patch.object(cloud_disk, 'DeviceManager',
+                                    autospec=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rpc_manager = cloud_disk.RpcManager()
+        self.rpc_manager._workers = {}
+
+    def test_execute_uses_worker(self, mock_execute, mock_sleep):
+        worker = mock.Mock(available=True)
+        worker.execute.return_value = 'out'
+        self.rpc_manager._workers = {'nbl_rpc.py': worker}
+        self.assertEqual('out', self.rpc_manager._execute('nbl_rpc.py', 'foo'))
+        worker.execute.assert_called_once_with('foo')
+        self.assertFalse(mock_execute.called)
+
+    def test_execute_worker_failed(self, mock_execute, mock_sleep):
+        worker = mock.Mock(available=True)
+        worker.execute.side_effect = cloud_disk.RpcWorkerError('boom')
+        self.rpc_manager._workers = {'nbl_rpc.py': worker}
+        mock_execute.return_value = ('out', '')
+        self.assertEqual('out', self.rpc_manager._execute('nbl_rpc.py', 'foo'))
+        mock_execute.assert_called_once_with('nbl_rpc.py', 'foo')
+
+    def test_execute_not_run_twice(self, mock_execute, mock_sleep):
+        worker = mock.Mock(available=True)
+        worker.execute.side_effect = cloud_disk.RpcReplyError('boom')
+        self.rpc_manager._workers = {'nbl_stor_rpc.py': worker}
+        self.rpc_manager.device_manager.get_iscsi_name.return_value = 'iscsi0'
+        self.assertRaises(cloud_disk.RpcCommandError,
+                          self.rpc_manager.execute_rpc_create_iscsi_bdev,
+                          IQN, IP)
+        self.assertFalse(mock_execute.called)
+        self.assertFalse(
+            self.rpc_manager.device_manager.add_device_name.called)
+
+    @mock.patch.object(cloud_disk, 'LOG', autospec=True)
+    def test_execute_stderr_is_not_an_error(self, mock_log, mock_execute,
+                                            mock_sleep):
+        mock_execute.return_value = ('out', 'warning')
+        self.assertEqual('out', self.rpc_manager._execute('nbl_rpc.py', 'foo'))
+        mock_log.warning.assert_called_once_with(
+            'nbl_rpc.py foo wrote to stderr: warning')
+
+    def test_execute_rpc_create_iscsi_bdev(self, mock_execute, mock_sleep):
+        device_manager = self.rpc_manager.device_manager
+        device_manager.get_iscsi_name.return_value = 'iscsi0'
+        mock_execute.return_value = ('out', '')
+
+        self.assertEqual(
+            'iscsi0', self.rpc_manager.execute_rpc_create_iscsi_bdev(IQN, IP))
+
+        mock_execute.assert_called_once_with(
+            'nbl_stor_rpc.py', 'bdev_iscsi_create', '-b', 'iscsi0',
+            '-i', IQN + '/0', '--url', f'iscsi://{IP}/{IQN}/0')
+        device_manager.add_device_name.assert_called_once_with(
+            'iscsi0', ('iscsi', IP, IQN))
+
+    def test_execute_rpc_emulator_virtio_blk_device_create(self, mock_execute,
+                                                           mock_sleep):
+        device_manager = self.rpc_manager.device_manager
+        device_manager.get_blk_name.return_value = 'blk0'
+        mock_execute.return_value = ('out', '')
+
+        self.assertEqual(
+            'blk0',
+            self.rpc_manager.execute_rpc_emulator_virtio_blk_device_create(
+                'iscsi0', IP, IQN))
+
+        mock_execute.assert_called_once_with(
+            'nbl_rpc.py', 'emulator_virtio_blk_device_create',
+            '--name', 'blk0', '--cpumask', '0x2', '--num_queues', '1',
+            '--bdev_name', 'iscsi0', '--rom_idx', '0')
+        device_manager.add_device_name.assert_called_once_with(
+            'blk0', ('blk', IP, IQN))
+
+    def test_execute_rpc_failed(self, mock_execute, mock_sleep):
+        mock_execute.side_effect = processutils.ProcessExecutionError(
+            stderr='error', exit_code=1)
+        self.assertRaises(cloud_disk.RpcCommandError,
+                          self.rpc_manager.execute_rpc_bdev_iscsi_delete,
+                          'iscsi0')
+        self.assertFalse(
+            self.rpc_manager.device_manager.remove_device_name.called)
+
+    def test_wait_iscsi_bdev_released(self, mock_execute, mock_sleep):
+        mock_execute.side_effect = [
+            ('[{"name": "iscsi0", "claimed": true}]', ''),
+            ('[{"name": "iscsi0", "claimed": true}]', ''),
+            ('[{"name": "iscsi0", "claimed": false}]', ''),
+        ]
+        self.assertTrue(self.rpc_manager.wait_iscsi_bdev_released('iscsi0'))
+        mock_execute.assert_called_with('nbl_stor_rpc.py', 'bdev_get_bdevs',
+                                        '-b', 'iscsi0')
+        self.assertEqual(3, mock_execute.call_count)
+        mock_sleep.assert_has_calls([mock.call(0.05), mock.call(0.1)])
+
+    @mock.patch.object(cloud_disk.time, 'monotonic', autospec=True)
+    def test_wait_iscsi_bdev_released_timeout(self, mock_monotonic,
+                                              mock_execute, mock_sleep):
+        mock_monotonic.side_effect = [0, 5, 9.5, 10]
+        mock_execute.side_effect = [
+            ('[{"name": "iscsi0", "claimed": true}]', ''),
+            processutils.ProcessExecutionError(stderr='error', exit_code=1),
+            ('not json', ''),
+        ]
+        self.assertFalse(self.rpc_manager.wait_iscsi_bdev_released('iscsi0'))
+        mock_sleep.assert_has_calls([mock.call(0.05), mock.call(0.1)])
+        self.assertEqual(3, mock_execute.call_count)
+
+
+@mock.patch.object(cloud_disk.shutil, 'which', autospec=True,
+                   return_value='/usr/bin/nbl_rpc.py')
+@mock.patch.object(cloud_disk.subprocess, 'Popen', autospec=True)
+class TestRpcWorker(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestRpcWorker, self).setUp()
+        self.worker = cloud_disk.RpcWorker('nbl_rpc.py')
+        self.proc = mock.Mock()
+        self.proc.poll.return_value = None
+
+    def test_execute(self, mock_popen, mock_which):
+        mock_popen.return_value = self.proc
+        self.proc.stdout.readline.side_effect = [
+            'line1\n', 'line2\n', '**STATUS=0\n', 'line3\n', '**STATUS=0\n']
+
+        self.assertEqual('line1\nline2\n',
+                         self.worker.execute('foo', '--name', 'a b'))
+        self.assertEqual('line3\n', self.worker.execute('bar'))
+
+        mock_which.assert_called_once_with('nbl_rpc.py')
+        mock_popen.assert_called_once_with(
+            ['/usr/bin/nbl_rpc.py', '--server'],
+            stdin=cloud_disk.subprocess.PIPE,
+            stdout=cloud_disk.subprocess.PIPE,
+            stderr=cloud_disk.subprocess.STDOUT, universal_newlines=True,
+            bufsize=1, close_fds=False)
+        self.proc.stdin.write.assert_has_calls([
+            mock.call("foo --name 'a b'\n"), mock.call('bar\n')])
+
+    def test_execute_command_failed(self, mock_popen, mock_which):
+        mock_popen.return_value = self.proc
+        self.proc.stdout.readline.side_effect = ['error\n', '**STATUS=1\n']
+        self.assertRaises(processutils.ProcessExecutionError,
+                          self.worker.execute, 'foo')
+        self.assertTrue(self.worker.available)
+
+    def test_execute_server_exited(self, mock_popen, mock_which):
+        mock_popen.return_value = self.proc
+        self.proc.stdout.readline.return_value = ''
+        self.assertRaises(cloud_disk.RpcReplyError,
+                          self.worker.execute, 'foo')
+        self.assertTrue(self.worker.available)
+        self.proc.stdin.close.assert_called_once_with()
+
+        self.proc.stdout.readline.side_effect = ['out\n', '**STATUS=0\n']
+        self.assertEqual('out\n', self.worker.execute('bar'))
+        self.assertEqual(2, mock_popen.call_count)
+
+    def test_execute_bad_reply(self, mock_popen, mock_which):
+        mock_popen.return_value = self.proc
+        self.proc.stdout.readline.side_effect = UnicodeDecodeError(
+            'utf-8', b'\xff', 0, 1, 'invalid start byte')
+        self.assertRaises(cloud_disk.RpcReplyError,
+                          self.worker.execute, 'foo')
+        self.assertTrue(self.worker.available)
+        self.proc.stdin.close.assert_called_once_with()
+
+    def test_execute_bad_status(self, mock_popen, mock_which):
+        mock_popen.return_value = self.proc
+        self.proc.stdout.readline.side_effect = ['**STATUS=oops\n']
+        self.assertRaises(cloud_disk.RpcReplyError,
+                          self.worker.execute, 'foo')
+        self.proc.stdin.close.assert_called_once_with()
+
+    @mock.patch.object(cloud_disk, 'RPC_TIMEOUT', 0.01)
+    def test_execute_timeout(self, mock_popen, mock_which):
+        mock_popen.return_value = self.proc
+        killed = threading.Event()
+        self.proc.kill.side_effect = killed.set
+        self.proc.stdout.readline.side_effect = (
+            lambda: '' if killed.wait(5) else '**STATUS=0\n')
+        self.assertRaises(cloud_disk.RpcReplyError,
+                          self.worker.execute, 'foo')
+        self.assertTrue(killed.is_set())
+
+    def test_execute_write_failed(self, mock_popen, mock_which):
+        mock_popen.return_value = self.proc
+        self.proc.stdin.flush.side_effect = BrokenPipeError
+        self.assertRaises(cloud_disk.RpcWorkerError,
+                          self.worker.execute, 'foo')
+        self.assertFalse(self.worker.available)
+        self.assertFalse(self.proc.stdout.readline.called)
+
+    def test_execute_start_failed(self, mock_popen, mock_which):
+        mock_popen.side_effect = OSError('boom')
+        self.assertRaises(cloud_disk.RpcWorkerError,
+                          self.worker.execute, 'foo')
+        self.assertFalse(self.worker.available)
+
+    def test_execute_not_found(self, mock_popen, mock_which):
+        mock_which.return_value = None
+        self.assertRaises(cloud_disk.RpcWorkerError,
+                          self.worker.execute, 'foo')
+        self.assertFalse(mock_popen.called)
+        self.assertFalse(self.worker.available)
+
+
+class TestCloudDiskExtension(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestCloudDiskExtension, self).setUp()
+        patcher = mock.patch.object(cloud_disk, 'RpcManager', autospec=True)
+        self.mock_rpc_manager = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(cloud_disk.atexit, 'register',
+                                    autospec=True)
+        self.mock_register = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.agent_extension = cloud_disk.CloudDiskExtension()
+        self.rpc_manager = self.agent_extension.rpc_manager
+        self.device_manager = mock.Mock(spec=cloud_disk.DeviceManager)
+        self.rpc_manager.device_manager = self.device_manager
+        self.mock_iscsi_create = self.rpc_manager.execute_rpc_create_iscsi_bdev
+        self.mock_iscsi_delete = self.rpc_manager.execute_rpc_bdev_iscsi_delete
+        self.mock_blk_create = (
+            self.rpc_manager.execute_rpc_emulator_virtio_blk_device_create)
+        self.mock_blk_delete = (
+            self.rpc_manager.execute_rpc_emulator_virtio_blk_device_delete)
+
+    def test_connect_cloud_disk(self):
+        self.mock_iscsi_create.return_value = 'iscsi0'
+        self.mock_blk_create.return_value = 'blk0'
+
+        result = self.agent_extension.connect_cloud_disk(iqn=IQN, ip=IP)
+
+        self.assertEqual({'result': 'Cloud disk connected successfully.'},
+                         result.command_result)
+        self.mock_iscsi_create.assert_called_once_with(IQN, IP)
+        self.mock_blk_create.assert_called_once_with('iscsi0', IP, IQN)
+        self.assertFalse(self.mock_iscsi_delete.called)
+
+    def test_connect_cloud_disk_rollback(self):
+        self.mock_iscsi_create.return_value = 'iscsi0'
+        self.mock_blk_create.side_effect = cloud_disk.RpcCommandError(
+            'boom', {})
+
+        with mock.patch.object(cloud_disk.CloudDiskExtension,
+                               '_rollback_pool', autospec=True) as mock_pool:
+            self.assertRaises(cloud_disk.BadRequest,
+                              self.agent_extension.connect_cloud_disk,
+                              iqn=IQN, ip=IP)
+        mock_pool.submit.assert_called_once_with(
+            self.agent_extension._rollback_iscsi_bdev, 'iscsi0')
+        self.assertFalse(self.mock_iscsi_delete.called)
+        self.assertEqual({(IP, IQN): mock_pool.submit.return_value},
+                         self.agent_extension._rollbacks)
+
+    def test_connect_cloud_disk_retry_waits_for_rollback(self):
+        self.mock_iscsi_create.return_value = 'iscsi0'
+        self.mock_blk_create.side_effect = [
+            cloud_disk.RpcCommandError('boom', {}), 'blk0']
+        creates_before_wait = []
+
+        with mock.patch.object(cloud_disk.CloudDiskExtension,
+                               '_rollback_pool', autospec=True) as mock_pool:
+            future = mock_pool.submit.return_value
+            future.result.side_effect = lambda: creates_before_wait.append(
+                self.mock_iscsi_create.call_count)
+            self.assertRaises(cloud_disk.BadRequest,
+                              self.agent_extension.connect_cloud_disk,
+                              iqn=IQN, ip=IP)
+            result = self.agent_extension.connect_cloud_disk(iqn=IQN, ip=IP)
+
+        self.assertEqual({'result': 'Cloud disk connected successfully.'},
+                         result.command_result)
+        self.assertEqual([1], creates_before_wait)
+        self.assertEqual(2, self.mock_iscsi_create.call_count)
+
+    def test_finished_rollback_is_forgotten(self):
+        pool = cloud_disk.futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(cloud_disk.CloudDiskExtension,
+                               '_rollback_pool', pool):
+            self.agent_extension._start_rollback(IP, IQN, 'iscsi0')
+            self.agent_extension._wait_for_rollback(IP, IQN)
+            pool.shutdown()
+        self.mock_iscsi_delete.assert_called_once_with('iscsi0')
+        self.assertEqual({}, self.agent_extension._rollbacks)
+
+    def test_rollbacks_drained_at_exit(self):
+        self.mock_register.assert_called_once_with(
+            cloud_disk.CloudDiskExtension._rollback_pool.shutdown)
+        calls = []
+        self.mock_rpc_manager.side_effect = (
+            lambda: calls.append('rpc_manager') or mock.DEFAULT)
+        self.mock_register.side_effect = lambda func: calls.append(func)
+        cloud_disk.CloudDiskExtension()
+        # Registered after the DeviceManager hook, so it runs before it.
+        self.assertEqual(
+            ['rpc_manager',
+             cloud_disk.CloudDiskExtension._rollback_pool.shutdown], calls)
+
+    def test_rollback_iscsi_bdev(self):
+        self.agent_extension._rollback_iscsi_bdev('iscsi0')
+        self.mock_iscsi_delete.assert_called_once_with('iscsi0')
+
+    def test_rollback_iscsi_bdev_failed(self):
+        self.mock_iscsi_delete.side_effect = cloud_disk.RpcCommandError(
+            'boom', {})
+        self.agent_extension._rollback_iscsi_bdev('iscsi0')
+        self.mock_iscsi_delete.assert_called_once_with('iscsi0')
+
+    @mock.patch.object(cloud_disk.CloudDiskExtension, 'print_all_devices',
+                       autospec=True)
+    def test_disconnect_cloud_disk(self, mock_print):
+        self.device_manager.check_blk_name.return_value = 'blk0'
+        self.device_manager.check_iscsi_name.return_value = 'iscsi0'
+
+        result = self.agent_extension.disconnect_cloud_disk(iqn=IQN, ip=IP)
+
+        self.assertEqual({'result': 'Cloud disk disconnected successfully.'},
+                         result.command_result)
+        self.mock_blk_delete.assert_called_once_with('blk0')
+        self.rpc_manager.wait_iscsi_bdev_released.assert_called_once_with(
+            'iscsi0')
+        self.mock_iscsi_delete.assert_called_once_with('iscsi0')
+
+    @mock.patch.object(cloud_disk.CloudDiskExtension, 'print_all_devices',
+                       autospec=True)
+    def test_disconnect_cloud_disk_missing_iscsi(self, mock_print):
+        self.device_manager.check_blk_name.return_value = 'blk0'
+        self.device_manager.check_iscsi_name.side_effect = ValueError('boom')
+
+        self.assertRaises(cloud_disk.BadRequest,
+                          self.agent_extension.disconnect_cloud_disk,
+                          iqn=IQN, ip=IP)
+        self.assertFalse(self.mock_blk_delete.called)
+        self.assertFalse(self.rpc_manager.wait_iscsi_bdev_released.called)
+
+    def test_check_heartbeat(self):
+        result = self.agent_extension.check_heartbeat(ip=IP).join()
+        self.assertEqual({'result': 'Cloud disk heartbeat successfully.'},
+                         result.command_result)
@@ -2,14 +2,12 @@
 
 import sys
 import json
+import shlex
 
-# 定义一个字典，用于控制特定命令是否应返回错误
-error_commands = {
-    "bdev_iscsi_create": False,
-    "emulator_virtio_blk_device_create": False,
-    "emulator_virtio_blk_device_delete": False,
-    "bdev_iscsi_delete": False
-}
+# 需要模拟返回错误的命令集合，例如：
+# frozenset({"bdev_iscsi_create", "emulator_virtio_blk_device_create",
+#            "emulator_virtio_blk_device_delete", "bdev_iscsi_delete"})
+error_commands = frozenset()
 
 class FakeCommandError(Exception):
     """模拟命令执行错误的异常类"""
@@ -18,18 +16,35 @@ class FakeCommandError(Exception):
 def fake_execute(command):
     """
     模拟执行RPC命令，根据每个具体命令返回成功或错误消息。
-    在错误配置为True时抛出异常。
+    命令在error_commands中时抛出异常。
     """
-    print(f"Executing: {' '.join(command)}")
+    sys.stdout.write(f"Executing: {' '.join(command)}\n")
 
     cmd_key = command[0]  # 假定命令名称总是在第一个参数位置
-    if error_commands.get(cmd_key, False):
+    if cmd_key in error_commands:
         raise FakeCommandError(f"{cmd_key} command failed as configured")
 
     # 根据命令返回模拟的成功信息
     return json.dumps({"status": "success", "message": f"{cmd_key} command executed successfully"})
 
+def serve():
+    """
+    模拟SPDK rpc.py的--server模式：从stdin逐行读取命令，
+    每条命令的输出以"**STATUS=0"（成功）或"**STATUS=1"（失败）结尾。
+    """
+    for line in sys.stdin:
+        try:
+            print(fake_execute(shlex.split(line)))
+            print("**STATUS=0", flush=True)
+        except (FakeCommandError, ValueError, IndexError) as e:
+            # 空行或引号不匹配等非法命令同样以失败状态回复，不能退出服务
+            print(str(e))
+            print("**STATUS=1", flush=True)
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--server"]:
+        serve()
+        sys.exit(0)
     try:
         args = sys.argv[1:]
         result = fake_execute(args)